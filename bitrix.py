@@ -3,72 +3,206 @@
 
 
 import logging
-from functools import lru_cache
+from urllib.parse import quote
 
+import orjson
 from requests import Session
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
 
+BATCH_LIMIT = 50  # max sub-commands Bitrix24 accepts in a single batch call
+PAGE_SIZE = 50    # items Bitrix24 list methods return per call
+
+
 class BitrixAPIError(Exception):
     pass
 
+
+def _buildQuery(in_params: dict, in_prefix: str = '') -> str:
+    """Encode nested params the way PHP's http_build_query does (used by batch commands)."""
+    pairs = []
+    items = in_params.items() if isinstance(in_params, dict) else enumerate(in_params)
+    for k, v in items:
+        # Like PHP, null entries are left out and booleans become 1/0
+        if v is None:
+            continue
+        key = f"{in_prefix}[{k}]" if in_prefix else str(k)
+        if isinstance(v, bool):
+            v = int(v)
+        if isinstance(v, (dict, list, tuple)):
+            nested = _buildQuery(v, key)
+            if nested:
+                pairs.append(nested)
+        else:
+            pairs.append(f"{quote(key)}={quote(str(v))}")
+    return '&'.join(pairs)
+
+
 class BitrixFillInData:
     def __init__(self, in_bitrixWebHook: str):
         self.bitrixWebHook = in_bitrixWebHook
+        # Per-instance memo for findBitrixUserByEmail; email count is small so it is unbounded
+        self._emailCache: dict[str, int] = {}
         self.session = Session()
         retries = Retry(
             total=5,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504],
-            allowed_methods=["POST"]
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
         )
-        adapter = HTTPAdapter(max_retries=retries)
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=32, pool_maxsize=32)
         self.session.mount("https://", adapter)
         self.session.mount("http://", adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.headers['Connection'] = 'keep-alive'
+        # Bodies are encoded with orjson in callBitrixMethod, so the header is set once here
+        self.session.headers['Content-Type'] = 'application/json'
 
     def callBitrixMethod(self, in_method: str, in_params: dict | list) -> dict:
         """General helper to call Bitrix24 via webhook with retry logic."""
         url = f"{self.bitrixWebHook}{in_method}"
-        resp = self.session.post(url, json=in_params)
+        resp = self.session.post(url, data=orjson.dumps(in_params))
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if "error" in data:
             msg = data.get("error_description", data["error"])
             raise BitrixAPIError(f"{in_method}: {msg!r}")
         return data.get("result", {})
 
-    @lru_cache(maxsize=100)
+    def callBitrixBatch(self, in_commands: list) -> list:
+        """Run (method, params) commands via the batch endpoint, BATCH_LIMIT per HTTP call.
+
+        Returns one result per command in the original order; failed commands yield None.
+        """
+        results = []
+        for start in range(0, len(in_commands), BATCH_LIMIT):
+            chunk = in_commands[start:start + BATCH_LIMIT]
+            params = {
+                'halt': 0,
+                'cmd': {f'c{i}': f'{m}?{_buildQuery(p)}' for i, (m, p) in enumerate(chunk)}
+            }
+            result = self.callBitrixMethod('batch', params)
+            # PHP serializes an empty associative array as a list
+            cmdResults = result.get('result') or {}
+            cmdErrors = result.get('result_error') or {}
+            for i, (m, _) in enumerate(chunk):
+                if f'c{i}' in cmdErrors:
+                    err = cmdErrors[f'c{i}']
+                    logging.error(f"Batch command {m} failed: {err.get('error_description', err)!r}")
+                results.append(cmdResults.get(f'c{i}') if isinstance(cmdResults, dict) else None)
+        return results
+
+    def _listAll(self, in_method: str, in_params: dict, in_key: str) -> list:
+        """Fetch every item of a Bitrix24 list method without server-side counting.
+
+        start=-1 turns off the total count, so instead of offsets the loop pages by ID:
+        items come ordered by ID and each request asks for IDs above the last seen one.
+        """
+        items = []
+        lastId = 0
+        while True:
+            params = dict(in_params)
+            params['filter'] = {**in_params.get('filter', {}), '>ID': lastId}
+            params['order'] = {'ID': 'ASC'}
+            params['start'] = -1
+            result = self.callBitrixMethod(in_method, params)
+            batch = result.get(in_key, []) if isinstance(result, dict) else []
+            items.extend(batch)
+            if len(batch) < PAGE_SIZE:
+                break
+            lastId = int(batch[-1].get('id') or batch[-1].get('ID'))
+        return items
+
+    def loadEmailIndex(self) -> dict:
+        """Return {lowercased email: user ID} for all Bitrix24 portal users."""
+        users = []
+        start = 0
+        while True:
+            result = self.callBitrixMethod('user.get', {'start': start})
+            batch = result if isinstance(result, list) else []
+            users.extend(batch)
+            if len(batch) < PAGE_SIZE:
+                break
+            start += len(batch)
+        index = {u['EMAIL'].lower(): int(u['ID']) for u in users if u.get('EMAIL')}
+        logging.info(f"Loaded {len(index)} Bitrix24 user emails")
+        return index
+
     def findBitrixUserByEmail(self, in_email: str) -> int | None:
         """Return existing Bitrix24 user ID by email, or None."""
+        # Only hits are memoized: a miss may be followed by creating that user
+        if in_email in self._emailCache:
+            return self._emailCache[in_email]
+        userId = None
         params = {'filter': {'EMAIL': in_email}, 'start': 0}
         result = self.callBitrixMethod('user.get', params)
         if isinstance(result, list) and result:
             try:
-                return int(result[0]['ID'])
+                userId = int(result[0]['ID'])
             except (KeyError, ValueError):
-                return None
-        return None
+                userId = None
+        if userId is not None:
+            self._emailCache[in_email] = userId
+        return userId
 
-    def addBitrixUser(self, in_user: dict, in_departmentNr: int = 1) -> dict:
-        """Add a user to Bitrix24 portal based on Jira user."""
+    def findBitrixUsersByEmail(self, in_emails: list) -> dict:
+        """Look several emails up with batched user.get calls; returns {lowercased email: ID} for found ones."""
+        found, lookup = {}, []
+        for email in dict.fromkeys(in_emails):
+            if email in self._emailCache:
+                found[email.lower()] = self._emailCache[email]
+            else:
+                lookup.append(email)
+        commands = [('user.get', {'filter': {'EMAIL': email}}) for email in lookup]
+        for email, result in zip(lookup, self.callBitrixBatch(commands)):
+            if isinstance(result, list) and result:
+                try:
+                    userId = int(result[0]['ID'])
+                except (KeyError, ValueError):
+                    continue
+                self._emailCache[email] = userId
+                found[email.lower()] = userId
+        return found
+
+    def _userFields(self, in_user: dict, in_departmentNr: int = 1) -> dict:
+        """Build user.add fields for a Jira user."""
         # Разбираем displayName на имя и фамилию
-        parts = in_user['displayName'].split()
+        parts = in_user['displayName'].split(None, 1)
         name = parts[0]
         lastName = parts[1] if len(parts) > 1 else ''
 
         # Структура полей согласно методу user.add
-        fields = {
+        return {
             'EMAIL': in_user['email'],
             'NAME': name,
             'LAST_NAME': lastName,
             "UF_DEPARTMENT": [in_departmentNr]
         }
+
+    def addBitrixUser(self, in_user: dict, in_departmentNr: int = 1) -> dict:
+        """Add a user to Bitrix24 portal based on Jira user."""
         # Передаём поля напрямую без обёртки 'fields'
-        result = self.callBitrixMethod('user.add', fields)
+        result = self.callBitrixMethod('user.add', self._userFields(in_user, in_departmentNr))
         logging.info(f"Created Bitrix24 user {result} for Jira user {in_user['key']}")
         return result
 
+    def addBitrixUsers(self, in_users: list, in_departmentNr: int = 1) -> list:
+        """Add several users in batch calls; returns the new user IDs in order (None on failure)."""
+        commands = [('user.add', self._userFields(u, in_departmentNr)) for u in in_users]
+        userIds = []
+        for user, result in zip(in_users, self.callBitrixBatch(commands)):
+            userId = int(result) if result else None
+            if userId:
+                logging.info(f"Created Bitrix24 user {userId} for Jira user {user['key']}")
+            else:
+                logging.error(f"Failed to create Bitrix24 user for Jira user {user['key']}")
+            userIds.append(userId)
+        return userIds
+
     def findBitrixTaskByTitle(self, in_title: str) -> int | None:
         """Return existing Bitrix24 task ID by exact title, or None."""
         params = {'filter': {'TITLE': in_title}, 'select': ['ID'], 'start': 0}
@@ -81,6 +215,16 @@ class BitrixFillInData:
                 return None
         return None
 
+    def loadTaskTitleIndex(self, in_groupId: int | None = None) -> dict:
+        """Return {title: task ID} for all Bitrix24 tasks, optionally limited to one workgroup."""
+        params = {
+            'filter': {'GROUP_ID': in_groupId} if in_groupId else {},
+            'select': ['ID', 'TITLE']
+        }
+        index = {t['title']: int(t['id']) for t in self._listAll('tasks.task.list', params, 'tasks')}
+        logging.info(f"Loaded {len(index)} Bitrix24 task titles")
+        return index
+
     def deleteBitrixTask(self, id_taskId: int) -> bool:
         """Delete a task in Bitrix24 via tasks.task.delete."""
         result = self.callBitrixMethod('tasks.task.delete', {'taskId': id_taskId})
@@ -91,47 +235,89 @@ class BitrixFillInData:
             logging.error(f"Failed to delete Bitrix24 task {id_taskId}")
             return False
 
+    def _taskFields(self, in_issue: dict, in_contactMap: dict, in_taskGroup: int = None,
+                    in_title: str = None) -> dict:
+        """Build tasks.task.add fields for a Jira issue; in_title avoids rebuilding a known title."""
+        f = in_issue['fields']
+        key = in_issue['key']
+        # Jira sends explicit null for unassigned issues, so "or {}" covers both missing and null
+        assignee = (f.get('assignee') or {}).get('name') or 'Nobody'
+        reporter = (f.get('reporter') or {}).get('name') or 'Nobody'
+        title = in_title if in_title is not None else f"{key}: {f['summary']}"
+        fields = {
+            'TITLE': title,
+            'DESCRIPTION': f.get('description', ''),
+            'RESPONSIBLE_ID': in_contactMap.get(assignee),
+            'CREATED_BY': in_contactMap.get(reporter),
+            'CREATED_DATE': f.get('created', ''),
+            'CHANGED_DATE': f.get('updated', ''),
+            'GROUP_ID': in_taskGroup
+        }
+        return fields
+
     def createBitrixTask(self, in_issue: dict, in_contactMap: dict,
-                         in_deleteIfExist: bool = False, in_taskGroup: int = None) -> dict | int:
-        """Create a task in Bitrix24 based on a Jira issue, skipping if exists."""
+                         in_deleteIfExist: bool = False, in_taskGroup: int = None,
+                         in_titleIndex: dict = None) -> dict | int:
+        """Create a task in Bitrix24 based on a Jira issue, skipping if exists.
+
+        When in_titleIndex (see loadTaskTitleIndex) is given, existing tasks are looked up there
+        instead of querying Bitrix24 for every issue.
+        """
         title = f"{in_issue['key']}: {in_issue['fields']['summary']}"
-        existing = self.findBitrixTaskByTitle(title)
+        if in_titleIndex is None:
+            existing = self.findBitrixTaskByTitle(title)
+        else:
+            existing = in_titleIndex.get(title)
 
         if existing and not in_deleteIfExist:
             logging.info(f"Task '{title}' already exists as ID {existing}, skipping creation")
             return existing
         elif existing and in_deleteIfExist:
             self.deleteBitrixTask(existing)
-        if in_issue['fields'].get('assignee', {}) is None:
-            assignee = "Nobody"
-        else:
-            assignee = in_issue['fields'].get('assignee', {}).get('name')
-        if in_issue['fields'].get('reporter', {}) is None:
-            reporter = "Nobody"
-        else:
-            reporter = in_issue['fields'].get('reporter', {}).get('name')
-        fields = {
-            'TITLE': f"{in_issue['key']}: {in_issue['fields']['summary']}",
-            'DESCRIPTION': in_issue['fields'].get('description', ''),
-            'RESPONSIBLE_ID': in_contactMap.get(assignee),
-            'CREATED_BY': in_contactMap.get(reporter),
-            'CREATED_DATE': in_issue['fields'].get('created', ''),
-            'CHANGED_DATE': in_issue['fields'].get('updated', ''),
-            'GROUP_ID': in_taskGroup
-        }
+            if in_titleIndex is not None:
+                in_titleIndex.pop(title, None)
+        fields = self._taskFields(in_issue, in_contactMap, in_taskGroup, title)
         result = self.callBitrixMethod('tasks.task.add', {'fields': fields})
         logging.info(f"Created Bitrix24 task {result} for Jira issue {in_issue['key']}")
         return result
 
+    def createBitrixTasks(self, in_issues: list, in_contactMap: dict, in_taskGroup: int = None,
+                          in_titleIndex: dict = None) -> list:
+        """Create tasks for Jira issues in batch calls, skipping ones that already exist.
+
+        Returns the IDs of tasks created in this call, in issue order; issues whose task already
+        existed (or failed to be created) get None, so callers don't migrate their comments twice.
+        """
+        taskIds, commands, pending = [], [], []
+        for issue in in_issues:
+            title = f"{issue['key']}: {issue['fields']['summary']}"
+            if in_titleIndex is None:
+                existing = self.findBitrixTaskByTitle(title)
+            else:
+                existing = in_titleIndex.get(title)
+            if existing:
+                logging.info(f"Task '{title}' already exists as ID {existing}, skipping creation")
+            else:
+                commands.append(('tasks.task.add', {'fields': self._taskFields(issue, in_contactMap, in_taskGroup, title)}))
+                pending.append(len(taskIds))
+            taskIds.append(None)
+        for idx, result in zip(pending, self.callBitrixBatch(commands)):
+            if result:
+                taskIds[idx] = int(result['task']['id'])
+                logging.info(f"Created Bitrix24 task {taskIds[idx]} for Jira issue {in_issues[idx]['key']}")
+            else:
+                logging.error(f"Failed to create Bitrix24 task for Jira issue {in_issues[idx]['key']}")
+        return taskIds
+
     def getBitrixWorkgroups(self, in_filter: dict = None, in_select: list = None) -> list:
         """Fetch workgroups from Bitrix24 via socialnetwork.api.workgroup.list."""
         params = {}
         if in_filter is not None:
             params['filter'] = in_filter
         if in_select is not None:
-            params['select'] = in_select
-        result = self.callBitrixMethod('socialnetwork.api.workgroup.list', params)
-        return result.get('workgroups', [])
+            # ID is needed to page through the list
+            params['select'] = in_select if 'ID' in in_select else ['ID', *in_select]
+        return self._listAll('socialnetwork.api.workgroup.list', params, 'workgroups')
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -2,17 +2,25 @@
 # Copyright (c) 2025 Timur Tsedik
 
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import orjson
+from diskcache import Cache
 from requests import Session
 from requests.auth import HTTPBasicAuth
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+CACHE_VERSION = 1  # bump to invalidate responses cached by older versions of the tool
+
+
 class JiraAPIError(Exception):
     pass
 
 class JiraFetchData:
-    def __init__(self, in_jiraUrl: str, in_jiraUserName: str, in_jiraPass: str, in_maxResults: int = 50, in_verifySsl: bool = False):
+    def __init__(self, in_jiraUrl: str, in_jiraUserName: str, in_jiraPass: str, in_maxResults: int = 50, in_verifySsl: bool = False,
+                 in_cacheDir: str | None = None, in_cacheTtl: int = 24 * 60 * 60):
         self.jiraUrl = in_jiraUrl
         self.maxResults = in_maxResults
         self.verify = in_verifySsl
@@ -21,61 +29,108 @@ class JiraFetchData:
         self.session = Session()
         retries = Retry(
             total=5,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504],
-            allowed_methods=["GET", "POST"]
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
         )
-        adapter = HTTPAdapter(max_retries=retries)
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=32, pool_maxsize=32)
         self.session.mount("https://", adapter)
         self.session.mount("http://", adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.headers['Connection'] = 'keep-alive'
+        self._pool = ThreadPoolExecutor(max_workers=int(os.getenv("JIRA_WORKERS", "8")))
+        # With in_cacheDir set, responses are cached on disk so reruns skip the Jira crawl.
+        # Entries are per Jira user, as accounts may see different issues
+        self._cacheUser = in_jiraUserName
+        self._cache = Cache(in_cacheDir, tag_index=True) if in_cacheDir else None
+        self._cacheTtl = in_cacheTtl
+        self._assigneeKeys = None
+        self._issuesByProject = None
 
-    def _get(self, in_path: str, **kwargs) -> list | dict:
+    def _get(self, in_path: str, in_cacheTag: str = None, **kwargs) -> list | dict:
+        """GET a Jira REST path; in_cacheTag groups cached entries so they can be evicted together."""
+        cacheKey = None
+        if self._cache is not None:
+            params = kwargs.get('params') or {}
+            cacheKey = (CACHE_VERSION, self.jiraUrl, self._cacheUser, in_path, tuple(sorted(params.items())))
+            cached = self._cache.get(cacheKey)
+            if cached is not None:
+                return orjson.loads(cached)
         url = f"{self.jiraUrl}{in_path}"
         resp = self.session.get(url, auth=self.auth, verify=self.verify, **kwargs)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if "error" in data:
             msg = data.get("error_description", data["error"])
             raise JiraAPIError(f"{in_path}: {msg!r}")
+        if cacheKey is not None:
+            self._cache.set(cacheKey, orjson.dumps(data), expire=self._cacheTtl, tag=in_cacheTag)
         return data
 
-    def fetchJiraUsers(self, in_prefix: str) -> list:
-        """Fetch all Jira users whose username starts with the given prefix."""
-        users = []
+    def iterJiraUsers(self, in_prefix: str, in_includeInactive: bool = False):
+        """Yield Jira users whose username starts with the given prefix, page by page.
+
+        Inactive accounts are left out by Jira itself unless in_includeInactive is set.
+        """
         startAt = 0
     
         while True:
-            params = {'username': in_prefix, 'startAt': startAt, 'maxResults': self.maxResults}
+            params = {'username': in_prefix, 'startAt': startAt, 'maxResults': self.maxResults,
+                      'includeActive': 'true', 'includeInactive': 'true' if in_includeInactive else 'false'}
             resp = self._get("/rest/api/2/user/search", params=params)
             if not isinstance(resp, list) or not resp:
                 break
             for u in resp:
-                users.append({
+                yield {
                     'key': u.get('name'),
                     'email': u.get('emailAddress'),
                     'displayName': u.get('displayName'),
                     'active': u.get('active')
-                })
+                }
             if len(resp) < self.maxResults:
                 break
             startAt += len(resp)
-    
+
+    def fetchJiraUsers(self, in_prefix: str, in_includeInactive: bool = False) -> list:
+        """Fetch all Jira users whose username starts with the given prefix."""
+        users = list(self.iterJiraUsers(in_prefix, in_includeInactive))
         logging.info(f"Fetched {len(users)} Jira users with prefix '{in_prefix}'")
         return users
     
-    def collectAssigneeKeys(self) -> list:
-        """Collect all distinct assignee usernames across all Jira issues."""
+    def iterAllIssues(self) -> dict:
+        """Return {projectKey: [issues]} for every Jira project, fetched once per run."""
+        if self._issuesByProject is None:
+            self._issuesByProject = {proj['key']: self.fetchJiraIssues(proj['key'])
+                                     for proj in self.fetchJiraProjects()}
+        return self._issuesByProject
+
+    def collectAssigneeKeys(self, in_issuesByProject: dict = None) -> list:
+        """Collect all distinct assignee usernames across all Jira issues.
+
+        Pass in_issuesByProject (see iterAllIssues) to reuse issues that were already fetched.
+        """
+        # Computed once per run for the full issue set (what iterAllIssues returns): both the
+        # users and the issues steps need it. Other issue sets are never memoized.
+        fullSet = in_issuesByProject is None or in_issuesByProject is self._issuesByProject
+        if fullSet and self._assigneeKeys is not None:
+            return self._assigneeKeys
         keys = set()
         usersData = []
-        for proj in self.fetchJiraProjects():
-            for issue in self.fetchJiraIssues(proj['key']):
+        if in_issuesByProject is None:
+            in_issuesByProject = self.iterAllIssues()
+        for issues in in_issuesByProject.values():
+            for issue in issues:
                 assignee = issue['fields'].get('assignee')
-                if assignee and assignee.get('name'):
-                    keyLen = len(keys)
-                    keys.add(assignee['name']) # assignee['emailAddress'],
-                    if len(keys) > keyLen:
-                        usersData.append([assignee['emailAddress'], assignee['name']])
+                name = assignee.get('name') if assignee else None
+                if name and name not in keys:
+                    keys.add(name)
+                    usersData.append([assignee['emailAddress'], name])
         logging.info(f"Collected {len(keys)} distinct assignee usernames from Jira issues")
+        if fullSet:
+            self._assigneeKeys = usersData
         return usersData
     
     def fetchJiraUserByKey(self, in_username: str) -> dict | None:
@@ -99,27 +154,46 @@ class JiraFetchData:
         return ret
 
     def fetchJiraIssues(self, in_projectKey: str) -> list:
-        """Fetch all issues for a given Jira project."""
-        issues = []
-        startAt = 0
+        """Fetch all issues for a given Jira project, requesting pages concurrently."""
         jql = f"project={in_projectKey} ORDER BY created ASC"
-    
-        while True:
-            params = {
-                'jql': jql,
-                'startAt': startAt,
-                'maxResults': self.maxResults,
-                'fields': 'summary,description,issuetype,assignee,reporter,created,updated'
-            }
-            resp = self._get("/rest/api/2/search", params=params)
-            batch = resp.get('issues', [])
-            if not batch:
-                break
-            issues.extend(batch)
-            if len(batch) < self.maxResults:
-                break
-            startAt += len(batch)
-    
+        fields = 'summary,description,issuetype,assignee,reporter,created,updated'
+        cacheTag = f"search:{self._cacheUser}:{jql}"
+
+        def _params(in_startAt: int) -> dict:
+            return {'jql': jql, 'startAt': in_startAt, 'maxResults': self.maxResults, 'fields': fields}
+
+        # The first page gives the total and the page size Jira actually serves, which can be
+        # below MAX_RESULTS because the server caps maxResults
+        first = self._get("/rest/api/2/search", in_cacheTag=cacheTag, params=_params(0))
+        total = int(first.get('total', 0))
+        issues = first.get('issues', [])
+        step = min(int(first.get('maxResults') or self.maxResults), len(issues) or self.maxResults)
+
+        futures = {}
+        for startAt in range(len(issues), total, step):
+            futures[self._pool.submit(self._get, "/rest/api/2/search", in_cacheTag=cacheTag,
+                                      params=_params(startAt))] = startAt
+
+        pages = {}
+        for future in as_completed(futures):
+            pages[futures[future]] = future.result().get('issues', [])
+        for startAt in sorted(pages):
+            issues.extend(pages[startAt])
+
+        # Short pages (e.g. issues created or deleted meanwhile) leave gaps; redo it sequentially.
+        # The cached pages of this project are evicted first, otherwise the refetch would replay them
+        if len(issues) != total:
+            logging.warning(f"Got {len(issues)} of {total} issues from project {in_projectKey}, refetching sequentially")
+            if self._cache is not None:
+                self._cache.evict(cacheTag)
+            issues = []
+            while True:
+                batch = self._get("/rest/api/2/search", in_cacheTag=cacheTag,
+                                  params=_params(len(issues))).get('issues', [])
+                if not batch:
+                    break
+                issues.extend(batch)
+
         logging.info(f"Fetched {len(issues)} issues from project {in_projectKey}")
         return issues
     
@@ -2,13 +2,14 @@
 # Copyright (c) 2025 Timur Tsedik
 
 import logging
-import re
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 
 from dotenv import load_dotenv
 
-from bitrix import BitrixFillInData
+from bitrix import BitrixAPIError, BitrixFillInData
 from jira import JiraFetchData
 
 
@@ -21,24 +22,13 @@ logging.basicConfig(
     ]
 )
 
-def ensureUser(in_bitrix: BitrixFillInData, in_email: str, in_name: str) -> int:
-    bitrixId = in_bitrix.findBitrixUserByEmail(in_email)
-    if bitrixId:
-        logging.info(f"{in_email!r} already exists (ID={bitrixId})")
-        return bitrixId
-    first, *rest = in_name.split(maxsplit=1)
-    last = rest[0] if rest else ""
-    return in_bitrix.addBitrixUser({
-        "email": in_email,
-        "name": first,
-        "lastName": last,
-    })['id']
-
-def mapUsers(jira: JiraFetchData) ->dict:
-    userMap = {}
-    for user in jira.fetchJiraUsers(''):
-        userMap[user['key']] = user['email']
-    assignees = jira.collectAssigneeKeys()
+# Control chars (0x00-0x1F and 0x7F) are removed, non-breaking spaces replaced with normal spaces
+_CTRL_TABLE = dict.fromkeys(list(range(0x20)) + [0x7F], None)
+_CTRL_TABLE[0xA0] = 0x20
+
+def mapUsers(jira: JiraFetchData, in_issuesByProject: dict = None) ->dict:
+    userMap = {u['key']: u['email'] for u in jira.iterJiraUsers('')}
+    assignees = jira.collectAssigneeKeys(in_issuesByProject)
     # combine unique assignees with their emails
     for assignee in assignees:
         userMap[assignee[1]] = assignee[0]
@@ -51,71 +41,108 @@ def mapUsers(jira: JiraFetchData) ->dict:
 def migrateUsers(in_extraKeys: list, in_jira: JiraFetchData, in_bitrix: BitrixFillInData) -> dict:
     """Migrate Jira users to Bitrix24 portal users and return mapping of Jira key to Bitrix ID."""
     userMap, seen = {}, set()
-    # Scan by prefix
-    for letter in 'abcdefghijklmnopqrstuvwxyz':
-        for user in in_jira.fetchJiraUsers(letter):
-            if user['key'] in seen or not user['active']:
+    candidates = []
+    # Scan by prefix for active users; the Jira queries run concurrently
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(in_jira.fetchJiraUsers, 'abcdefghijklmnopqrstuvwxyz'))
+    for users in results:
+        for user in users:
+            if user['key'] in seen:
                 continue
             seen.add(user['key'])
-            email = user['email']
-            name = user['displayName']
-            bitrixId = ensureUser(in_bitrix, email, name)
-            userMap[user['key']] = bitrixId
+            candidates.append(user)
 
     # Handle assignees not covered by prefix scan
     for key in in_extraKeys:
         if key[1] in seen:
             continue
         seen.add(key[1])
-        name = key[1]
-        email = key[0]
-        bitrixId = ensureUser(in_bitrix, email, name)
-        userMap[key[1]] = bitrixId
+        candidates.append({'key': key[1], 'email': key[0], 'displayName': key[1]})
     # Create NULL user for cases when assignee not specified
-    email = "nobody@example.com"
-    name = "Nobody"
-    bitrixId = in_bitrix.findBitrixUserByEmail(email)
-    if bitrixId:
-        logging.info(f"User with email {email} already exists as ID {bitrixId}")
-    else:
-        user = {'active': True, 'displayName': name, 'email': email, 'key': name}
-        bitrixId = in_bitrix.addBitrixUser(user)
-        logging.info(f"Created Bitrix24 user {bitrixId} for Jira user {user['key']}")
-    userMap[name] = bitrixId
+    if 'Nobody' not in seen:
+        candidates.append({'key': 'Nobody', 'email': 'nobody@example.com', 'displayName': 'Nobody'})
+
+    # One paginated user listing instead of a user.get call per email
+    try:
+        emailIndex = in_bitrix.loadEmailIndex()
+    except BitrixAPIError as e:
+        # Without the listing, fall back to looking the candidates' emails up (still batched)
+        logging.warning(f"Could not list Bitrix24 users ({e}), looking emails up directly")
+        emailIndex = in_bitrix.findBitrixUsersByEmail([u['email'] for u in candidates if u['email']])
+    missing = {}  # email -> (user to create, Jira keys sharing that email)
+    for user in candidates:
+        email = user['email']
+        bitrixId = emailIndex.get(email.lower()) if email else None
+        if bitrixId:
+            logging.info(f"{email!r} already exists (ID={bitrixId})")
+            userMap[user['key']] = bitrixId
+        else:
+            missing.setdefault(email.lower() if email else user['key'], (user, []))[1].append(user['key'])
+
+    # New users go out in batch calls
+    newUsers = list(missing.values())
+    for (_, keys), bitrixId in zip(newUsers, in_bitrix.addBitrixUsers([u for u, _ in newUsers])):
+        for key in keys:
+            userMap[key] = bitrixId
     return userMap
 
 def sanitizeMessage(in_msg: str) -> str:
     """Remove special/control characters from the message."""
-    # Replace non-breaking spaces with normal spaces
-    ret = in_msg.replace(' ', ' ')
-    # Remove other control chars (0x00-0x1F and 0x7F)
-    ret = re.sub(r'[\x00-\x1F\x7F]', '', ret)
-    return ret
+    # Single pass: non-breaking spaces become normal spaces, control chars are dropped
+    return in_msg.translate(_CTRL_TABLE)
 
 def migrateIssues(in_contactMap: dict, in_jira: JiraFetchData, in_bitrix: BitrixFillInData,
-                  in_projectId: str = None, in_taskGroup: int = None):
-    """Migrate Jira issues (tasks) into Bitrix24."""
-    projects = in_jira.fetchJiraProjects()
-    counter = 0
-    for proj in projects:
-        key = proj['key']
+                  in_projectId: str = None, in_taskGroup: int = None, in_deleteIfExist: bool = True,
+                  in_issuesByProject: dict = None):
+    """Migrate Jira issues (tasks) into Bitrix24.
+
+    Pass in_issuesByProject (see JiraFetchData.iterAllIssues) to reuse issues that were already fetched.
+    """
+    if in_issuesByProject is None:
+        projectKeys = [proj['key'] for proj in in_jira.fetchJiraProjects()]
+    else:
+        projectKeys = list(in_issuesByProject)
+    counter = count(1)
+
+    def _migrateOne(in_issue: dict, in_taskId: int | None) -> None:
+        if in_deleteIfExist:
+            in_taskId = in_bitrix.createBitrixTask(in_issue, in_contactMap, in_deleteIfExist=True,
+                                                   in_taskGroup=in_taskGroup, in_titleIndex=titleIndex)
+            if isinstance(in_taskId, dict):
+                in_taskId = in_taskId['task']['id']
+        logging.info(f"Issue # {next(counter)}")
+        if not in_taskId:
+            return
+        # migrate comments, sent to Bitrix in batches of BATCH_LIMIT
+        commands = []
+        for c in in_jira.fetchComments(in_issue['key']):
+            body = sanitizeMessage(c.get('body'))
+            params = {'TASKID': in_taskId,
+                      'FIELDS': {'POST_MESSAGE': body,
+                                 'AUTHOR_ID': in_contactMap.get(c.get('author', {}).get('name'))}}
+            commands.append(('task.commentitem.add', params))
+            logging.info(f"params: {params}")
+        if commands:
+            in_bitrix.callBitrixBatch(commands)
+
+    for key in projectKeys:
         if in_projectId and in_projectId == key:
-            issues = in_jira.fetchJiraIssues(key)
-            for issue in issues:
-                taskId = in_bitrix.createBitrixTask(issue, in_contactMap, in_deleteIfExist=True, in_taskGroup=in_taskGroup)
-                counter += 1
-                logging.info(f"Issue # {counter}")
-                # migrate comments if needed
-                comments = in_jira.fetchComments(issue['key'])
-                for c in comments:
-                    if isinstance(taskId, dict):
-                        taskId = taskId['task']['id']
-                    body = sanitizeMessage(c.get('body'))
-                    params = [taskId,
-                         {'POST_MESSAGE': body,
-                                'AUTHOR_ID': in_contactMap.get(c.get('author', {}).get('name'))}]
-                    in_bitrix.callBitrixMethod('task.commentitem.add', params)
-                    logging.info(f"params: {params}")
+            if in_issuesByProject is None:
+                issues = in_jira.fetchJiraIssues(key)
+            else:
+                issues = in_issuesByProject[key]
+            # One paginated listing instead of a title lookup per issue
+            titleIndex = in_bitrix.loadTaskTitleIndex(in_taskGroup)
+            if in_deleteIfExist:
+                # Tasks are deleted and recreated one by one inside _migrateOne
+                taskIds = [None] * len(issues)
+            else:
+                # Nothing gets deleted, so all new tasks can go out in batch calls; existing
+                # tasks come back as None and keep the comments they already have
+                taskIds = in_bitrix.createBitrixTasks(issues, in_contactMap, in_taskGroup=in_taskGroup,
+                                                      in_titleIndex=titleIndex)
+            with ThreadPoolExecutor(max_workers=int(os.getenv('BITRIX_WORKERS', '8'))) as ex:
+                list(ex.map(_migrateOne, issues, taskIds))
 
 
 def main():
@@ -126,19 +153,26 @@ def main():
     jiraUserPass = os.getenv('JIRA_TOKEN')
     maxResults = int(os.getenv('MAX_RESULTS', '50'))
     webHook = os.getenv('BITRIX_WEBHOOK')
+    cacheTtl = int(os.getenv('JIRA_CACHE_TTL', str(24 * 60 * 60)))
 
-    jira = JiraFetchData(in_jiraUrl=jiraUrl, in_jiraPass=jiraUserPass, in_jiraUserName=jiraUserName, in_maxResults=maxResults)
+    jira = JiraFetchData(in_jiraUrl=jiraUrl, in_jiraPass=jiraUserPass, in_jiraUserName=jiraUserName, in_maxResults=maxResults,
+                         in_cacheDir=None if args.no_cache else '.jira_cache', in_cacheTtl=cacheTtl)
     bitrix = BitrixFillInData(webHook)
 
     logging.info("Starting migration from Jira to Bitrix24...")
 
+    # Every step walks all issues (assignees, issue migration); crawl Jira once and share the result
+    issuesByProject = jira.iterAllIssues()
+
     if args.step in ('users', 'all'):
-        assignees = jira.collectAssigneeKeys()
+        assignees = jira.collectAssigneeKeys(issuesByProject)
         userMap = migrateUsers(assignees, in_jira=jira, in_bitrix=bitrix)
         logging.info(f"user map: {userMap}")
     if args.step in ('issues', 'all'):
-        userMap = mapUsers(jira)
-        migrateIssues(userMap, in_projectId=args.project, in_taskGroup=args.group, in_jira=jira, in_bitrix=bitrix)
+        userMap = mapUsers(jira, issuesByProject)
+        migrateIssues(userMap, in_projectId=args.project, in_taskGroup=args.group,
+                      in_deleteIfExist=not args.keep_existing, in_issuesByProject=issuesByProject,
+                      in_jira=jira, in_bitrix=bitrix)
         logging.info("Migration completed.")
 
 
@@ -161,6 +195,16 @@ def parse_args():
         type=int,
         help='Bitrix24 workgroup ID for created tasks'
     )
+    parser.add_argument(
+        '--keep-existing',
+        action='store_true',
+        help='Keep existing Bitrix24 tasks instead of deleting and recreating them'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Always query Jira instead of using responses cached in .jira_cache'
+    )
 
     return parser.parse_args()
 